@@ -2,12 +2,16 @@
 Flask Web应用主文件
 实现AI音乐推荐智能体的HTTP API接口
 """
+import gc
 import os
+import asyncio
 import logging
-from flask import Flask, request, jsonify
+import orjson
+from flask import Flask, Response, request
 from flask_cors import CORS
-from llm_client import create_llm_client, MusicRecommendationClient
+from llm_client import create_llm_client, MusicRecommendationClient, CircuitOpenError, LLMRequestError
 from knowledge_base import KnowledgeBase
+from llm_cache import LLMCache
 
 # 配置日志
 logging.basicConfig(
@@ -21,35 +25,265 @@ app = Flask(__name__)
 CORS(app)  # 允许跨域请求
 
 # 初始化组件
+# 从环境变量读取LLM提供商配置
+llm_provider = os.getenv("LLM_PROVIDER", "deepseek")
+logger.info(f"🤖 使用LLM提供商: {llm_provider}")
+
+# 初始化知识库：不依赖LLM配置，单独初始化，LLM客户端创建失败时 /stats、/health 仍可用
 try:
-    # 从环境变量读取LLM提供商配置
-    llm_provider = os.getenv("LLM_PROVIDER", "deepseek")
-    logger.info(f"🤖 使用LLM提供商: {llm_provider}")
-    
-    # 创建LLM客户端
+    knowledge_base = KnowledgeBase()
+except Exception as e:
+    logger.error(f"❌ 知识库初始化失败: {e}")
+    knowledge_base = None
+
+try:
+    # 创建LLM客户端（内部复用模块级的HTTP连接池）
     llm_client = create_llm_client(llm_provider)
     
-    # 创建音乐推荐客户端（封装了业务逻辑）
-    music_client = MusicRecommendationClient(llm_client)
-    
-    # 初始化知识库
-    knowledge_base = KnowledgeBase()
+    # 创建音乐推荐客户端（封装了业务逻辑），知识库词表用于快速意图识别
+    music_client = MusicRecommendationClient(llm_client, vocabulary=knowledge_base.get_vocabulary())
     logger.info("✅ 组件初始化成功")
 except Exception as e:
     logger.error(f"❌ 组件初始化失败: {e}")
     music_client = None
-    knowledge_base = None
+
+# 启动时加载的对象（知识库、索引等）此后基本不再变化：移出垃圾回收的扫描范围，
+# 使用 gunicorn --preload 时各worker可以通过写时复制共享这部分内存
+gc.freeze()
+
+
+# 完整推荐结果缓存：相同的提问（忽略空白和大小写）在有效期内直接返回，跳过全部大模型调用
+# 不按相似度匹配：长句中只改一个关键词（摇滚/流行、中文/英文）相似度仍然很高，会返回别的请求的结果
+response_cache = LLMCache(maxsize=2048, ttl=600)
+
+
+def cache_response(user_input, context, recommendation):
+    """
+    缓存推荐结果
+    
+    降级流程（熔断时）生成的静态回复不缓存，服务恢复后应重新走大模型推荐
+    """
+    if context["source"] == "offline":
+        return
+    response_cache.set(LLMCache.make_text_key(user_input), {
+        "recommendation": recommendation,
+        "matched_songs": context["matched_songs"][:5],
+        "intent": context["intent"],
+        "search_query": context["search_query"],
+        "source": context["source"]
+    })
+
+
+def ojsonify(obj):
+    """使用orjson序列化JSON响应（替代flask.jsonify，直接输出UTF-8字节）"""
+    return Response(orjson.dumps(obj), mimetype="application/json")
+
+
+def search_by_intent(intent_data):
+    """按意图识别结果直接做条件搜索（备用搜索方法）"""
+    return knowledge_base.search_by_conditions(
+        genre=intent_data.get('genre'),
+        mood=intent_data.get('mood'),
+        artist=intent_data.get('artist'),
+        title=intent_data.get('song'),
+        limit=5
+    )
+
+
+def get_user_input():
+    """
+    校验并读取请求中的用户输入
+    
+    Returns:
+        (user_input, error_response)，校验失败时user_input为None
+    """
+    # 检查组件是否初始化
+    if not music_client or not knowledge_base:
+        return None, (ojsonify({
+            "success": False,
+            "error": "服务未正确初始化，请检查配置"
+        }), 500)
+    
+    # 获取用户输入
+    data = request.get_json()
+    if not data or 'message' not in data:
+        return None, (ojsonify({
+            "success": False,
+            "error": "请提供 'message' 字段"
+        }), 400)
+    
+    user_input = data['message'].strip()
+    if not user_input:
+        return None, (ojsonify({
+            "success": False,
+            "error": "消息不能为空"
+        }), 400)
+    
+    return user_input, None
+
+
+def prepare_offline_recommendation(user_input):
+    """
+    LLM服务熔断时的降级流程：关键词识别意图 + 知识库条件搜索 + 静态推荐回复
+    
+    Returns:
+        与 prepare_recommendation 相同结构的字典，recommendation总是已生成
+    """
+    logger.warning("⚠️ LLM服务暂时不可用，使用降级推荐流程")
+    intent_data = music_client.extract_intent_fast(user_input)
+    if intent_data:
+        matched_songs = search_by_intent(intent_data)
+    else:
+        # 关键词无法识别需求时没有搜索条件，无条件搜索只会返回曲库的前几行，视为没有匹配
+        intent_data = {
+            "intent": "find_music",
+            "mood": None,
+            "genre": None,
+            "artist": None,
+            "song": None
+        }
+        matched_songs = []
+    logger.info(f"   找到 {len(matched_songs)} 首匹配的歌曲")
+    
+    return {
+        "recommendation": music_client.offline_recommendation(matched_songs),
+        "matched_songs": matched_songs,
+        "intent": intent_data,
+        "search_query": None,
+        "source": "offline"
+    }
+
+
+async def prepare_recommendation(user_input):
+    """
+    执行推荐流程中生成最终回复之前的步骤：需求分析和知识库搜索
+    
+    Returns:
+        包含 recommendation、matched_songs、intent、search_query、source 的字典；
+        recommendation为None表示需要再根据matched_songs生成推荐回复
+    """
+    logger.info(f"📩 收到用户请求: {user_input}")
+    
+    # LLM服务熔断中，不再等待必然失败的调用
+    if not music_client.llm_available:
+        return prepare_offline_recommendation(user_input)
+    
+    # 步骤1: 分析用户需求
+    # 简单的需求先用关键词匹配识别，命中时无需调用大模型
+    analysis = None
+    intent_data = music_client.extract_intent_fast(user_input)
+    
+    if intent_data:
+        logger.info("⚡ 步骤1: 关键词快速识别意图...")
+        logger.info(f"   识别结果: {intent_data}")
+        search_query = {
+            "genre": intent_data["genre"],
+            "mood": intent_data["mood"],
+            "artist": intent_data["artist"],
+            "title": intent_data["song"]
+        }
+        # 搜索条件与意图完全一致，备用搜索不会有新结果
+        fallback_songs = []
+    else:
+        # 一次大模型调用同时完成意图识别、生成搜索条件和推荐草稿
+        logger.info("🔍 步骤1: 分析用户需求...")
+        try:
+            analysis = await music_client.aanalyze_and_recommend(user_input)
+        except LLMRequestError as e:
+            # 请求本身的问题（如模型不支持 response_format 返回400、响应不是合法JSON）退回分步调用；
+            # 超时、5xx等服务故障直接抛出，分步调用只会再等几次超时
+            if e.service_failure:
+                raise
+            logger.warning(f"   结构化分析调用失败: {e}")
+            analysis = None
+        
+        if analysis:
+            intent_data = analysis["intent"]
+            search_query = analysis["filter_spec"]
+            logger.info(f"   识别结果: {intent_data}")
+            logger.info(f"   搜索查询: {search_query}")
+            fallback_songs = search_by_intent(intent_data)
+        else:
+            # 结构化分析失败时，退回意图识别 + 生成搜索查询的分步调用
+            logger.info("   结构化分析失败，改为分步调用...")
+            intent_data = await music_client.aextract_intent(user_input)
+            logger.info(f"   识别结果: {intent_data}")
+            
+            # 按意图直接条件搜索只依赖意图结果，与生成查询的大模型调用并发执行
+            available_fields = knowledge_base.get_available_fields()
+            search_query, fallback_songs = await asyncio.gather(
+                music_client.agenerate_search_query(intent_data, available_fields),
+                asyncio.to_thread(search_by_intent, intent_data)
+            )
+            logger.info(f"   搜索查询: {search_query}")
+    
+    # 步骤2: 执行搜索
+    logger.info("🔎 步骤2: 执行搜索...")
+    if any(isinstance(value, str) and value.strip() for value in search_query.values()):
+        matched_songs = knowledge_base.search(search_query)
+    else:
+        # 没有任何搜索条件时，无条件搜索只会返回曲库的前几行，视为没有匹配
+        logger.info("   没有可用的搜索条件，跳过知识库搜索")
+        matched_songs = fallback_songs = []
+    logger.info(f"   找到 {len(matched_songs)} 首匹配的歌曲")
+    
+    # 如果没有找到匹配的歌曲，使用备用搜索方法
+    if not matched_songs:
+        logger.info("   使用备用搜索方法...")
+        matched_songs = fallback_songs
+    
+    # 如果仍然没有找到匹配的歌曲，让大模型推荐通用歌曲
+    source = "knowledge_base"
+    if not matched_songs:
+        if analysis:
+            logger.info("   未找到匹配歌曲，使用大模型的推荐草稿...")
+            recommendation = analysis["draft_recommendation"]
+            matched_songs = analysis["recommended_songs"]
+        else:
+            logger.info("   未找到匹配歌曲，使用大模型推荐通用歌曲...")
+            llm_recommendation = await music_client.agenerate_recommendation_without_matches(
+                user_input,
+                intent_data
+            )
+    
+            recommendation = llm_recommendation.get("recommendation", "抱歉，我暂时无法为您推荐具体的歌曲。")
+            matched_songs = llm_recommendation.get("recommended_songs", [])
+        source = "llm_recommendation"
+    
+        logger.info(f"   大模型推荐了 {len(matched_songs)} 首歌曲")
+    elif analysis and music_client.draft_covers_songs(analysis["draft_recommendation"], matched_songs):
+        # 推荐草稿已经提到了匹配歌曲，省去一次大模型调用
+        logger.info("💬 推荐草稿已覆盖匹配歌曲，直接使用")
+        recommendation = analysis["draft_recommendation"]
+    else:
+        # 需要根据匹配歌曲重新生成推荐回复，由调用方决定是否流式生成
+        recommendation = None
+    
+    return {
+        "recommendation": recommendation,
+        "matched_songs": matched_songs,
+        "intent": intent_data,
+        "search_query": search_query if source == "knowledge_base" else None,
+        "source": source
+    }
+
+
+def sse_event(data, event=None):
+    """将数据编码为一条Server-Sent Events消息"""
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {orjson.dumps(data).decode()}\n\n"
 
 
 @app.route('/', methods=['GET'])
 def index():
     """根路径，返回API信息"""
-    return jsonify({
+    return ojsonify({
         "message": "AI音乐推荐智能体 API",
         "version": "1.0.0",
         "endpoints": {
             "/": "API信息",
             "/recommend": "POST - 获取音乐推荐",
+            "/recommend/stream": "POST - 获取音乐推荐（SSE流式返回）",
             "/health": "GET - 健康检查",
             "/stats": "GET - 知识库统计信息"
         }
@@ -63,22 +297,22 @@ def health():
         "status": "healthy",
         "llm_client": music_client is not None,
         "knowledge_base": knowledge_base is not None and len(knowledge_base.data) > 0,
-        "llm_provider": os.getenv("LLM_PROVIDER", "deepseek")
+        "llm_provider": llm_provider
     }
-    return jsonify(status)
+    return ojsonify(status)
 
 
 @app.route('/stats', methods=['GET'])
 def stats():
     """获取知识库统计信息"""
     if not knowledge_base:
-        return jsonify({"error": "知识库未初始化"}), 500
+        return ojsonify({"error": "知识库未初始化"}), 500
     
-    return jsonify(knowledge_base.get_statistics())
+    return ojsonify(knowledge_base.get_statistics())
 
 
 @app.route('/recommend', methods=['POST'])
-def recommend():
+async def recommend():
     """
     音乐推荐主端点
     
@@ -96,98 +330,117 @@ def recommend():
     }
     """
     try:
-        # 检查组件是否初始化
-        if not music_client or not knowledge_base:
-            return jsonify({
-                "success": False,
-                "error": "服务未正确初始化，请检查配置"
-            }), 500
-        
-        # 获取用户输入
-        data = request.get_json()
-        if not data or 'message' not in data:
-            return jsonify({
-                "success": False,
-                "error": "请提供 'message' 字段"
-            }), 400
+        user_input, error_response = get_user_input()
+        if error_response:
+            return error_response
         
-        user_input = data['message'].strip()
-        if not user_input:
-            return jsonify({
-                "success": False,
-                "error": "消息不能为空"
-            }), 400
+        cached = response_cache.get(LLMCache.make_text_key(user_input))
+        if cached is not None:
+            logger.info(f"⚡ 命中推荐结果缓存: {user_input}")
+            return ojsonify({"success": True, **cached})
         
-        logger.info(f"📩 收到用户请求: {user_input}")
+        try:
+            context = await prepare_recommendation(user_input)
+        except CircuitOpenError:
+            context = prepare_offline_recommendation(user_input)
         
-        # 步骤1: 意图识别
-        logger.info("🔍 步骤1: 意图识别...")
-        intent_data = music_client.extract_intent(user_input)
-        logger.info(f"   识别结果: {intent_data}")
+        recommendation = context["recommendation"]
+        if recommendation is None:
+            # 步骤3: 根据匹配歌曲生成推荐回复
+            logger.info("💬 步骤3: 生成推荐回复...")
+            try:
+                recommendation = await music_client.agenerate_recommendation(
+                    user_input,
+                    context["matched_songs"],
+                    context["intent"]
+                )
+            except CircuitOpenError:
+                # 标记为降级结果：静态回复不写入缓存，服务恢复后重新走大模型推荐
+                context["source"] = "offline"
+                recommendation = music_client.offline_recommendation(context["matched_songs"])
         
-        # 步骤2: 生成搜索查询
-        logger.info("🧠 步骤2: 生成搜索查询...")
-        available_fields = knowledge_base.get_available_fields()
-        search_query = music_client.generate_search_query(intent_data, available_fields)
-        logger.info(f"   搜索查询: {search_query}")
-        
-        # 步骤3: 执行搜索
-        logger.info("🔎 步骤3: 执行搜索...")
-        matched_songs = knowledge_base.search(search_query)
-        logger.info(f"   找到 {len(matched_songs)} 首匹配的歌曲")
-        
-        # 如果没有找到匹配的歌曲，使用备用搜索方法
-        if not matched_songs:
-            logger.info("   使用备用搜索方法...")
-            matched_songs = knowledge_base.search_by_conditions(
-                genre=intent_data.get('genre'),
-                mood=intent_data.get('mood'),
-                artist=intent_data.get('artist'),
-                title=intent_data.get('song'),
-                limit=5
-            )
-        
-        # 如果仍然没有找到匹配的歌曲，让大模型推荐通用歌曲
-        source = "knowledge_base"
-        if not matched_songs:
-            logger.info("   未找到匹配歌曲，使用大模型推荐通用歌曲...")
-            llm_recommendation = music_client.generate_recommendation_without_matches(
-                user_input,
-                intent_data
-            )
-            
-            recommendation = llm_recommendation.get("recommendation", "抱歉，我暂时无法为您推荐具体的歌曲。")
-            matched_songs = llm_recommendation.get("recommended_songs", [])
-            source = "llm_recommendation"
-            
-            logger.info(f"   大模型推荐了 {len(matched_songs)} 首歌曲")
-        else:
-            # 步骤4: 生成推荐回复（有匹配歌曲时）
-            logger.info("💬 步骤4: 生成推荐回复...")
-            recommendation = music_client.generate_recommendation(
-                user_input,
-                matched_songs,
-                intent_data
-            )
+        cache_response(user_input, context, recommendation)
         
         # 返回结果
-        return jsonify({
+        return ojsonify({
             "success": True,
             "recommendation": recommendation,
-            "matched_songs": matched_songs[:5],  # 限制返回数量
-            "intent": intent_data,
-            "search_query": search_query if source == "knowledge_base" else None,
-            "source": source
+            "matched_songs": context["matched_songs"][:5],  # 限制返回数量
+            "intent": context["intent"],
+            "search_query": context["search_query"],
+            "source": context["source"]
         })
     
     except Exception as e:
         logger.error(f"❌ 处理请求时出错: {str(e)}", exc_info=True)
-        return jsonify({
+        return ojsonify({
             "success": False,
             "error": f"服务器错误: {str(e)}"
         }), 500
 
 
+@app.route('/recommend/stream', methods=['POST'])
+async def recommend_stream():
+    """
+    流式音乐推荐端点（Server-Sent Events）
+    
+    请求体格式与 /recommend 相同。响应依次包含：
+    - event: meta  推荐的元数据（matched_songs、intent、search_query、source），前端可立即渲染
+    - data: {"delta": "..."}  推荐回复的文本增量
+    - event: done  推荐结束
+    处理过程中出错时发送 event: error
+    """
+    try:
+        user_input, error_response = get_user_input()
+        if error_response:
+            return error_response
+        
+        context = response_cache.get(LLMCache.make_text_key(user_input))
+        if context is not None:
+            logger.info(f"⚡ 命中推荐结果缓存: {user_input}")
+        else:
+            try:
+                context = await prepare_recommendation(user_input)
+            except CircuitOpenError:
+                context = prepare_offline_recommendation(user_input)
+    except Exception as e:
+        logger.error(f"❌ 处理请求时出错: {str(e)}", exc_info=True)
+        return ojsonify({
+            "success": False,
+            "error": f"服务器错误: {str(e)}"
+        }), 500
+    
+    def generate():
+        yield sse_event({
+            "matched_songs": context["matched_songs"][:5],
+            "intent": context["intent"],
+            "search_query": context["search_query"],
+            "source": context["source"]
+        }, event="meta")
+        
+        try:
+            recommendation = context["recommendation"]
+            if recommendation is None:
+                logger.info("💬 步骤3: 流式生成推荐回复...")
+                deltas = []
+                for delta in music_client.stream_recommendation(user_input, context["matched_songs"], context["intent"]):
+                    deltas.append(delta)
+                    yield sse_event({"delta": delta})
+                recommendation = "".join(deltas)
+            else:
+                yield sse_event({"delta": recommendation})
+            yield sse_event({}, event="done")
+            cache_response(user_input, context, recommendation)
+        except CircuitOpenError:
+            yield sse_event({"delta": music_client.offline_recommendation(context["matched_songs"])})
+            yield sse_event({}, event="done")
+        except Exception as e:
+            logger.error(f"❌ 流式生成推荐回复时出错: {str(e)}", exc_info=True)
+            yield sse_event({"error": f"服务器错误: {str(e)}"}, event="error")
+    
+    return Response(generate(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
 if __name__ == '__main__':
     # 从环境变量读取配置
     host = os.getenv('FLASK_HOST', '127.0.0.1')
@@ -0,0 +1,25 @@
+"""
+Gunicorn配置文件（生产环境）
+启动方式: gunicorn -c gunicorn.conf.py app:app
+"""
+import multiprocessing
+import os
+
+# 监听地址，与 app.py 直接运行时使用相同的环境变量和默认值；对外提供服务时设置 FLASK_HOST=0.0.0.0
+bind = f"{os.getenv('FLASK_HOST', '127.0.0.1')}:{os.getenv('FLASK_PORT', '5000')}"
+
+# 主进程加载应用后再fork：知识库、索引和HTTP连接池只加载一次，各worker写时复制共享
+preload_app = True
+
+# 每个请求大部分时间在等待大模型接口返回，用多线程worker让等待互相重叠
+worker_class = "gthread"
+workers = int(os.getenv("GUNICORN_WORKERS", min(multiprocessing.cpu_count() * 2 + 1, 8)))
+threads = int(os.getenv("GUNICORN_THREADS", 8))
+
+# 一次推荐可能包含多次大模型调用，超时时间要大于单次调用的读取超时
+timeout = 120
+graceful_timeout = 30
+keepalive = 5
+
+accesslog = "-"
+errorlog = "-"
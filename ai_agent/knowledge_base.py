@@ -2,9 +2,24 @@
 知识库管理模块
 用于加载和搜索JSON格式的音乐数据
 """
-import json
+import heapq
 import os
-from typing import List, Dict, Optional, Any
+import sys
+import orjson
+from itertools import islice
+from typing import List, Dict, Optional, Any, Set
+
+# 结构化搜索条件支持的字段
+FILTER_FIELDS = ("genre", "mood", "artist", "title")
+
+# 取值高度重复的字段，加载时驻留为同一个字符串对象
+INTERNED_FIELDS = ("genre", "mood", "artist", "language")
+
+
+def _bigrams(text: str) -> Set[str]:
+    """返回文本中所有相邻两个字符组成的片段（中文歌名、歌手名通常很短，二元组比三元组适用面更广）"""
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
 
 class KnowledgeBase:
     """JSON知识库管理类"""
@@ -18,6 +33,19 @@ class KnowledgeBase:
         """
         self.json_file_path = json_file_path
         self.data: List[Dict[str, Any]] = []
+        # 倒排索引：小写取值 -> 歌曲在 self.data 中的下标集合
+        self._by_genre: Dict[str, Set[int]] = {}
+        self._by_mood: Dict[str, Set[int]] = {}
+        self._by_artist: Dict[str, Set[int]] = {}
+        # 二元组索引：用于标题、歌手子串搜索的候选集过滤
+        # 标题：二元组 -> 歌曲下标集合；歌手：二元组 -> 去重后的歌手名集合
+        self._title_bigrams: Dict[str, Set[int]] = {}
+        self._artist_bigrams: Dict[str, Set[str]] = {}
+        # 预先小写化的标题列，与 self.data 按下标对齐
+        self._titles: List[str] = []
+        # 数据只在加载时变化，字段列表和统计信息在加载时一次算好
+        self._fields: List[str] = []
+        self._stats: Dict[str, Any] = {}
         self.load()
     
     def load(self) -> None:
@@ -25,48 +53,107 @@ class KnowledgeBase:
         if not os.path.exists(self.json_file_path):
             print(f"警告: 文件 {self.json_file_path} 不存在，将创建空数据")
             self.data = []
-            return
+        else:
+            try:
+                with open(self.json_file_path, 'rb') as f:
+                    self.data = orjson.loads(f.read())
+                
+                # 确保data是列表
+                if not isinstance(self.data, list):
+                    self.data = [self.data] if self.data else []
+                
+                print(f"成功加载 {len(self.data)} 条音乐数据")
+            except orjson.JSONDecodeError as e:
+                print(f"错误: JSON文件格式错误 - {e}")
+                self.data = []
+            except Exception as e:
+                print(f"错误: 加载文件失败 - {e}")
+                self.data = []
         
-        try:
-            with open(self.json_file_path, 'r', encoding='utf-8') as f:
-                self.data = json.load(f)
-            
-            # 确保data是列表
-            if not isinstance(self.data, list):
-                self.data = [self.data] if self.data else []
+        self._intern_values()
+        self._build_indexes()
+        self._fields = self._compute_fields()
+        self._stats = self._compute_statistics()
+    
+    def _intern_values(self) -> None:
+        """
+        驻留重复的字符串取值
+        
+        流派、情绪、歌手等字段只有少量不同取值，驻留后所有歌曲共享同一个字符串对象，
+        效果类似列式存储的字典编码，大曲库下可以明显降低内存占用
+        """
+        for song in self.data:
+            for field in INTERNED_FIELDS:
+                value = song.get(field)
+                if type(value) is str:
+                    song[field] = sys.intern(value)
+    
+    def _build_indexes(self) -> None:
+        """构建倒排索引，小写化只在加载时做一次"""
+        self._by_genre = {}
+        self._by_mood = {}
+        self._by_artist = {}
+        self._title_bigrams = {}
+        self._artist_bigrams = {}
+        self._titles = [str(song.get('title') or '').lower() for song in self.data]
+        
+        for i, song in enumerate(self.data):
+            for field, index in (('genre', self._by_genre), ('mood', self._by_mood), ('artist', self._by_artist)):
+                value = str(song.get(field) or '').lower()
+                if value:
+                    index.setdefault(value, set()).add(i)
             
-            print(f"成功加载 {len(self.data)} 条音乐数据")
-        except json.JSONDecodeError as e:
-            print(f"错误: JSON文件格式错误 - {e}")
-            self.data = []
-        except Exception as e:
-            print(f"错误: 加载文件失败 - {e}")
-            self.data = []
+            for gram in _bigrams(self._titles[i]):
+                self._title_bigrams.setdefault(gram, set()).add(i)
+        
+        for name in self._by_artist:
+            for gram in _bigrams(name):
+                self._artist_bigrams.setdefault(gram, set()).add(name)
+    
+    def _match_artist(self, artist: str) -> Set[int]:
+        """按歌手子串匹配，先用二元组索引缩小候选歌手名，再逐个确认"""
+        if len(artist) < 2:
+            names = self._by_artist.keys()
+        else:
+            names = set.intersection(*(self._artist_bigrams.get(gram, set()) for gram in _bigrams(artist)))
+        return set().union(*(self._by_artist[name] for name in names if artist in name))
+    
+    def _match_title(self, title: str) -> Set[int]:
+        """按标题子串匹配，先用二元组索引缩小候选集，再逐个确认"""
+        titles = self._titles
+        if len(title) < 2:
+            return {i for i, t in enumerate(titles) if title in t}
+        
+        candidates = set.intersection(*(self._title_bigrams.get(gram, set()) for gram in _bigrams(title)))
+        return {i for i in candidates if title in titles[i]}
     
     def reload(self) -> None:
         """重新加载数据"""
         self.load()
     
-    def search(self, query_code: str) -> List[Dict[str, Any]]:
+    def search(self, spec: Dict[str, Any], limit: int = 10) -> List[Dict[str, Any]]:
         """
-        使用生成的查询代码搜索数据
+        使用结构化过滤条件搜索数据
         
         Args:
-            query_code: Python搜索表达式，例如：
-                [song for song in songs if song.get('mood', '').lower() == 'sad']
+            spec: 过滤条件，例如：
+                {"genre": "rock", "mood": "sad", "title": "love"}
+                只识别 FILTER_FIELDS 中的字段，值为空或非字符串的字段会被忽略
+            limit: 返回结果数量限制
         
         Returns:
             匹配的歌曲列表
         """
-        try:
-            # 创建安全的执行环境
-            songs = self.data
-            # 执行查询代码
-            result = eval(query_code)
-            return result if isinstance(result, list) else []
-        except Exception as e:
-            print(f"搜索执行错误: {e}")
+        if not isinstance(spec, dict):
+            print(f"搜索条件格式错误: {spec!r}")
             return []
+        
+        conditions = {
+            field: spec[field].strip()
+            for field in FILTER_FIELDS
+            if isinstance(spec.get(field), str) and spec[field].strip()
+        }
+        return self.search_by_conditions(limit=limit, **conditions)
     
     def search_by_conditions(
         self,
@@ -77,7 +164,9 @@ class KnowledgeBase:
         limit: int = 10
     ) -> List[Dict[str, Any]]:
         """
-        使用条件直接搜索（备用方法）
+        使用条件直接搜索
+        
+        流派、情绪为精确匹配，歌手、歌曲标题为子串匹配，均不区分大小写
         
         Args:
             genre: 流派
@@ -89,50 +178,72 @@ class KnowledgeBase:
         Returns:
             匹配的歌曲列表
         """
-        results = []
+        candidates: Optional[Set[int]] = None
         
-        for song in self.data:
-            match = True
-            
-            if genre and song.get('genre', '').lower() != genre.lower():
-                match = False
-            if mood and song.get('mood', '').lower() != mood.lower():
-                match = False
-            if artist and artist.lower() not in song.get('artist', '').lower():
-                match = False
-            if title and title.lower() not in song.get('title', '').lower():
-                match = False
-            
-            if match:
-                results.append(song)
-                if len(results) >= limit:
-                    break
+        lookups = (
+            (genre, lambda v: self._by_genre.get(v, set())),
+            (mood, lambda v: self._by_mood.get(v, set())),
+            (artist, self._match_artist),
+            (title, self._match_title),
+        )
+        for value, lookup in lookups:
+            if not value:
+                continue
+            ids = lookup(value.lower())
+            candidates = ids if candidates is None else candidates & ids
+            if not candidates:
+                return []
         
-        return results
+        # 按原始数据顺序返回：只需要前limit个，用堆取最小的limit个下标，不对全部候选排序
+        if candidates is None:
+            indices = islice(range(len(self.data)), limit)
+        else:
+            indices = heapq.nsmallest(limit, candidates)
+        return [self.data[i] for i in indices]
     
     def get_available_fields(self) -> List[str]:
         """
-        获取数据中可用的字段列表
+        获取数据中可用的字段列表（加载时计算，直接返回缓存结果）
         
         Returns:
             字段名列表
         """
+        return self._fields
+    
+    def get_vocabulary(self) -> Dict[str, List[str]]:
+        """
+        获取知识库中出现过的全部流派、情绪和歌手（小写）
+        
+        Returns:
+            {"genres": [...], "moods": [...], "artists": [...]}
+        """
+        return {
+            "genres": sorted(self._by_genre),
+            "moods": sorted(self._by_mood),
+            "artists": sorted(self._by_artist)
+        }
+    
+    def get_all_songs(self) -> List[Dict[str, Any]]:
+        """获取所有歌曲"""
+        return self.data
+    
+    def get_statistics(self) -> Dict[str, Any]:
+        """获取知识库统计信息（加载时计算，直接返回缓存结果）"""
+        return self._stats
+    
+    def _compute_fields(self) -> List[str]:
+        """从所有记录中收集字段"""
         if not self.data:
             return []
         
-        # 从所有记录中收集字段
         fields = set()
         for song in self.data:
             fields.update(song.keys())
         
         return sorted(list(fields))
     
-    def get_all_songs(self) -> List[Dict[str, Any]]:
-        """获取所有歌曲"""
-        return self.data
-    
-    def get_statistics(self) -> Dict[str, Any]:
-        """获取知识库统计信息"""
+    def _compute_statistics(self) -> Dict[str, Any]:
+        """统计流派、情绪和歌手"""
         if not self.data:
             return {
                 "total_songs": 0,
@@ -145,13 +256,12 @@ class KnowledgeBase:
         moods = set()
         artists = set()
         
+        # 跳过缺失或非字符串的取值（如null），否则排序时会因类型不同而报错
         for song in self.data:
-            if 'genre' in song:
-                genres.add(song['genre'])
-            if 'mood' in song:
-                moods.add(song['mood'])
-            if 'artist' in song:
-                artists.add(song['artist'])
+            for field, values in (('genre', genres), ('mood', moods), ('artist', artists)):
+                value = song.get(field)
+                if isinstance(value, str):
+                    values.add(value)
         
         return {
             "total_songs": len(self.data),
@@ -159,4 +269,3 @@ class KnowledgeBase:
             "moods": sorted(list(moods)),
             "artists": sorted(list(artists))[:20]  # 限制艺术家数量
         }
-
@@ -0,0 +1,111 @@
+"""
+LLM响应缓存模块
+对请求体完全相同的低温度调用（意图识别、生成搜索条件等）直接复用之前的响应，
+也用于按归一化后的用户输入缓存意图、分析和推荐结果
+"""
+import copy
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import orjson
+
+
+class LLMCache:
+    """带过期时间的LRU缓存（线程安全），按请求内容的哈希值存取响应"""
+
+    def __init__(self, maxsize: int = 2048, ttl: float = 3600):
+        """
+        初始化响应缓存
+
+        Args:
+            maxsize: 最多缓存的响应数，超出后淘汰最久未使用的条目
+            ttl: 每条响应的有效期（秒）
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        # 正在请求中的键：键 -> [该键的锁, 等待/持有该锁的线程数]
+        self._inflight: Dict[str, List[Any]] = {}
+
+    @staticmethod
+    def make_key(url: str, payload: dict) -> str:
+        """
+        根据请求地址和请求体生成缓存键
+
+        请求体包含模型、消息、温度等全部参数，键排序后序列化，字段顺序不影响结果
+        """
+        data = orjson.dumps({"url": url, "payload": payload}, option=orjson.OPT_SORT_KEYS)
+        return hashlib.sha256(data).hexdigest()
+
+    @staticmethod
+    def make_text_key(text: str, context: Any = None) -> str:
+        """
+        根据用户输入生成缓存键
+
+        输入去除空白、转小写后完全相同才视为同一个键；context（可JSON序列化）不同的输入不会共用键
+        """
+        normalized = "".join(text.split()).lower()
+        data = orjson.dumps([normalized, context], option=orjson.OPT_SORT_KEYS)
+        return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+    def get(self, key: str) -> Optional[Any]:
+        """
+        读取缓存
+
+        Returns:
+            未过期时返回缓存响应的副本，否则返回None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+
+        return copy.deepcopy(value)
+
+    def set(self, key: str, value: Any) -> None:
+        """写入缓存"""
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, copy.deepcopy(value))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    @contextmanager
+    def single_flight(self, key: str) -> Iterator[None]:
+        """
+        同一个键同一时间只允许一个线程进入
+
+        并发的相同请求在此排队：第一个线程调用LLM并写入缓存，
+        其余线程进入后应先重新读取缓存，命中则不再发送请求
+        """
+        with self._lock:
+            entry = self._inflight.get(key)
+            if entry is None:
+                entry = self._inflight[key] = [threading.Lock(), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._inflight[key]
+
+    def clear(self) -> None:
+        """清空缓存"""
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -3,238 +3,466 @@
 支持多种LLM提供商：DeepSeek、OpenAI、Claude、通义千问等
 """
 import os
+import re
+import json
+import time
+import asyncio
+import hashlib
+import threading
+import orjson
 import requests
-from typing import Dict, List, Optional
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from functools import lru_cache
+from itertools import islice
+from typing import Dict, Iterator, List, Optional, Tuple
 from dotenv import load_dotenv
 from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from llm_cache import LLMCache
 
 load_dotenv()
 
+# (连接超时, 读取超时)：连接阶段快速失败，读取阶段给生成留出时间
+_REQUEST_TIMEOUT = (3.05, 20)
+# 快速模型的全局覆盖（环境变量只在导入时读取一次，不在每次调用时查询）
+_FAST_MODEL_OVERRIDE = os.getenv("LLM_FAST_MODEL")
+# 温度不高于该值的调用输出基本确定（意图识别、搜索条件等结构化抽取），可以缓存响应
+_CACHEABLE_TEMPERATURE = 0.3
+
+
+class CircuitOpenError(Exception):
+    """熔断器处于打开状态，请求未发送"""
+    pass
+
+
+class LLMRequestError(Exception):
+    """
+    LLM接口调用失败
+    
+    Attributes:
+        status: HTTP状态码，没有收到响应（连接失败、超时等）时为None
+        service_failure: 是否为服务不可用类的失败（连接失败、超时、429、5xx），
+            为False时是请求本身的问题（如400、响应不是合法JSON），换一种请求方式可能成功
+    """
+    
+    def __init__(self, message: str, status: Optional[int] = None, service_failure: bool = False):
+        super().__init__(message)
+        self.status = status
+        self.service_failure = service_failure
+
+
+class CircuitBreaker:
+    """
+    简单的熔断器（线程安全）
+    
+    连续失败达到fail_max次后打开，reset_timeout秒内的调用直接抛出CircuitOpenError；
+    超时后放行一次试探请求，成功则关闭，失败则重新打开
+    """
+    
+    def __init__(self, fail_max: int = 10, reset_timeout: float = 30):
+        self.fail_max = fail_max
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._lock = threading.Lock()
+    
+    @property
+    def is_open(self) -> bool:
+        """熔断器是否打开（试探期内视为关闭）"""
+        opened_at = self._opened_at
+        return opened_at is not None and time.monotonic() - opened_at < self.reset_timeout
+    
+    def before_call(self) -> None:
+        """发送请求前调用，熔断器打开时抛出CircuitOpenError"""
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                raise CircuitOpenError("LLM服务暂时不可用（熔断中）")
+            # 进入试探期：放行本次请求，并推迟其他请求直到试探结果返回
+            self._opened_at = time.monotonic()
+    
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+    
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.fail_max:
+                self._opened_at = time.monotonic()
+
+
+def _is_service_failure(error: Exception) -> bool:
+    """
+    判断请求异常是否说明LLM服务本身不可用，只有这类异常计入熔断器
+    
+    连接失败、超时、限流（429）和服务端错误（5xx，包括重试耗尽）计入；
+    400/401/404等是请求或配置错误，熔断无济于事，不计入
+    """
+    if isinstance(error, requests.exceptions.HTTPError):
+        status = error.response.status_code if error.response is not None else None
+        return status is not None and (status == 429 or status >= 500)
+    return isinstance(error, (
+        requests.exceptions.ConnectionError,
+        requests.exceptions.Timeout,
+        requests.exceptions.RetryError,
+        requests.exceptions.ChunkedEncodingError
+    ))
+
 
 class LLMClient(ABC):
     """LLM客户端抽象基类"""
     
+    # 错误信息中使用的提供商名称
+    error_prefix = "LLM API"
+    # 意图识别等结构化抽取任务使用的更快、更便宜的模型，None表示使用默认模型
+    FAST_MODEL: Optional[str] = None
+    # 熔断器，由子类在初始化时创建；为None时不做熔断
+    breaker: Optional[CircuitBreaker] = None
+    # 低温度调用的响应缓存，由子类在初始化时创建；为None时不缓存
+    cache: Optional[LLMCache] = None
+    
+    @property
+    def fast_model(self) -> str:
+        """结构化抽取任务使用的模型，可通过环境变量 LLM_FAST_MODEL 覆盖"""
+        return _FAST_MODEL_OVERRIDE or self.FAST_MODEL or self.default_model
+    
     @abstractmethod
-    def chat_completion(
+    def _build_request(
         self,
         messages: List[Dict[str, str]],
-        model: Optional[str] = None,
-        temperature: float = 0.7,
-        max_tokens: int = 2000
-    ) -> Dict:
-        """调用LLM聊天完成API"""
+        model: Optional[str],
+        temperature: float,
+        max_tokens: int,
+        response_format: Optional[Dict]
+    ) -> Tuple[str, Dict, Optional[Dict]]:
+        """
+        构建聊天完成请求
+        
+        Returns:
+            (url, payload, params) 三元组，params为URL查询参数，不需要时为None
+        """
         pass
-
-
-class DeepSeekClient(LLMClient):
-    """DeepSeek API客户端"""
     
-    def __init__(self, api_key: Optional[str] = None, base_url: str = "https://api.deepseek.com", model: str = "deepseek-chat"):
-        self.api_key = api_key or os.getenv("DEEPSEEK_API_KEY")
-        if not self.api_key:
-            raise ValueError("DeepSeek API密钥未设置，请设置环境变量 DEEPSEEK_API_KEY")
+    def _post_json(self, url: str, payload: Dict, params: Optional[Dict] = None, stream: bool = False) -> requests.Response:
+        """
+        通过共享会话发送JSON POST请求并检查状态码
         
-        self.base_url = base_url
-        self.default_model = model
-        self.headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.api_key}"
-        }
+        Args:
+            stream: 是否流式读取响应体，为True时调用方负责关闭响应
+        
+        Raises:
+            requests.exceptions.RequestException: 请求失败或返回错误状态码
+        """
+        # 用orjson直接序列化为UTF-8字节，中文内容不做\u转义；Content-Type已在self.headers中设置
+        response = self.session.post(
+            url,
+            headers=self.headers,
+            data=orjson.dumps(payload),
+            params=params,
+            timeout=_REQUEST_TIMEOUT,
+            stream=stream
+        )
+        try:
+            response.raise_for_status()
+        except requests.exceptions.HTTPError:
+            # 流式请求出错时连接不会自动归还连接池
+            response.close()
+            raise
+        return response
     
     def chat_completion(
         self,
         messages: List[Dict[str, str]],
         model: Optional[str] = None,
         temperature: float = 0.7,
-        max_tokens: int = 2000
+        max_tokens: int = 2000,
+        response_format: Optional[Dict] = None
     ) -> Dict:
-        url = f"{self.base_url}/v1/chat/completions"
+        """
+        调用LLM聊天完成API
         
-        payload = {
-            "model": model or self.default_model,
-            "messages": messages,
-            "temperature": temperature,
-            "max_tokens": max_tokens
-        }
+        Args:
+            response_format: 结构化输出格式，例如 {"type": "json_object"}，为None时不限制
         
-        try:
-            response = requests.post(url, headers=self.headers, json=payload, timeout=30)
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            raise Exception(f"DeepSeek API调用失败: {str(e)}")
-
-
-class OpenAIClient(LLMClient):
-    """OpenAI API客户端（兼容Azure OpenAI）"""
-    
-    def __init__(self, api_key: Optional[str] = None, base_url: Optional[str] = None, model: str = "gpt-3.5-turbo"):
-        self.api_key = api_key or os.getenv("OPENAI_API_KEY")
-        if not self.api_key:
-            raise ValueError("OpenAI API密钥未设置，请设置环境变量 OPENAI_API_KEY")
+        Raises:
+            CircuitOpenError: 连续失败过多、熔断器打开时不发送请求直接抛出
+            LLMRequestError: 请求失败、返回错误状态码或响应不是合法JSON
+        """
+        url, payload, params = self._build_request(messages, model, temperature, max_tokens, response_format)
         
-        # 支持Azure OpenAI（如果提供了base_url）
-        self.base_url = base_url or os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
-        self.default_model = model or os.getenv("OPENAI_MODEL", "gpt-3.5-turbo")
+        # 低温度调用：请求体完全相同时直接返回之前的响应
+        cache_key = None
+        if self.cache is not None and temperature <= _CACHEABLE_TEMPERATURE:
+            cache_key = self.cache.make_key(url, payload)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                return cached
         
-        self.headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.api_key}"
-        }
-    
-    def chat_completion(
-        self,
-        messages: List[Dict[str, str]],
-        model: Optional[str] = None,
-        temperature: float = 0.7,
-        max_tokens: int = 2000
-    ) -> Dict:
-        # Azure OpenAI使用不同的端点格式
-        if "openai.azure.com" in self.base_url or "azure.com" in self.base_url:
-            # Azure OpenAI格式: https://{resource}.openai.azure.com/openai/deployments/{deployment}/chat/completions?api-version=2024-02-15-preview
-            # 如果URL已经包含完整路径，直接使用；否则构建标准路径
-            if "/chat/completions" in self.base_url:
-                url = self.base_url
-            else:
-                deployment = model or self.default_model
-                url = f"{self.base_url.rstrip('/')}/openai/deployments/{deployment}/chat/completions"
-            # Azure需要api-version参数
-            params = {"api-version": os.getenv("AZURE_OPENAI_API_VERSION", "2024-02-15-preview")}
-            payload = {
-                "messages": messages,
-                "temperature": temperature,
-                "max_tokens": max_tokens
-            }
-        else:
-            # 标准OpenAI API
-            url = f"{self.base_url.rstrip('/')}/chat/completions"
-            params = None
-            payload = {
-                "model": model or self.default_model,
-                "messages": messages,
-                "temperature": temperature,
-                "max_tokens": max_tokens
-            }
+        if cache_key is None:
+            return self._request_completion(url, payload, params)
         
-        try:
-            response = requests.post(url, headers=self.headers, json=payload, params=params, timeout=30)
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            raise Exception(f"OpenAI API调用失败: {str(e)}")
-
-
-class QwenClient(LLMClient):
-    """通义千问（Qwen）API客户端"""
+        # 并发的相同请求只发送一次：后到的请求等第一个完成后直接读取缓存
+        with self.cache.single_flight(cache_key):
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                return cached
+            result = self._request_completion(url, payload, params)
+            self.cache.set(cache_key, result)
+        return result
     
-    def __init__(self, api_key: Optional[str] = None, base_url: str = "https://dashscope.aliyuncs.com/compatible-mode/v1", model: str = "qwen-turbo"):
-        self.api_key = api_key or os.getenv("QWEN_API_KEY")
-        if not self.api_key:
-            raise ValueError("通义千问API密钥未设置，请设置环境变量 QWEN_API_KEY")
+    def _request_completion(self, url: str, payload: Dict, params: Optional[Dict]) -> Dict:
+        """发送一次非流式请求并解析响应，经过熔断器"""
+        if self.breaker:
+            self.breaker.before_call()
+        try:
+            result = orjson.loads(self._post_json(url, payload, params).content)
+        except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
+            raise self._request_error(e)
         
-        self.base_url = base_url
-        self.default_model = model or os.getenv("QWEN_MODEL", "qwen-turbo")
-        self.headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.api_key}"
-        }
+        if self.breaker:
+            self.breaker.record_success()
+        return result
     
-    def chat_completion(
+    def stream_chat_completion(
         self,
         messages: List[Dict[str, str]],
         model: Optional[str] = None,
         temperature: float = 0.7,
         max_tokens: int = 2000
-    ) -> Dict:
-        url = f"{self.base_url}/chat/completions"
+    ) -> Iterator[str]:
+        """
+        以流式方式调用LLM聊天完成API
         
-        payload = {
-            "model": model or self.default_model,
-            "messages": messages,
-            "temperature": temperature,
-            "max_tokens": max_tokens
-        }
+        Yields:
+            模型逐段生成的文本增量
+        """
+        url, payload, params = self._build_request(messages, model, temperature, max_tokens, None)
+        payload["stream"] = True
         
+        if self.breaker:
+            self.breaker.before_call()
         try:
-            response = requests.post(url, headers=self.headers, json=payload, timeout=30)
-            response.raise_for_status()
-            return response.json()
+            with self._post_json(url, payload, params, stream=True) as response:
+                # 状态码正常即视为调用成功：调用方可能读到需要的内容后提前关闭流
+                if self.breaker:
+                    self.breaker.record_success()
+                # SSE格式：每个事件为一行 "data: {...}"，以 "data: [DONE]" 结束
+                for line in response.iter_lines():
+                    if not line.startswith(b"data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == b"[DONE]":
+                        break
+                    
+                    choices = orjson.loads(data).get("choices") or []
+                    delta = choices[0].get("delta", {}).get("content") if choices else None
+                    if delta:
+                        yield delta
         except requests.exceptions.RequestException as e:
-            raise Exception(f"通义千问API调用失败: {str(e)}")
-
-
-class ZhipuClient(LLMClient):
-    """智谱AI（GLM）API客户端"""
+            raise self._request_error(e)
     
-    def __init__(self, api_key: Optional[str] = None, model: str = "glm-4"):
-        self.api_key = api_key or os.getenv("ZHIPU_API_KEY")
-        if not self.api_key:
-            raise ValueError("智谱AI API密钥未设置，请设置环境变量 ZHIPU_API_KEY")
+    def _request_error(self, error: Exception) -> LLMRequestError:
+        """
+        将调用失败记录到熔断器，并转换为LLMRequestError
         
-        self.base_url = "https://open.bigmodel.cn/api/paas/v4/chat/completions"
-        self.default_model = model or os.getenv("ZHIPU_MODEL", "glm-4")
-        self.headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.api_key}"
-        }
+        服务不可用类的异常计为失败；其余错误（如400、响应格式错误）说明服务有响应，按成功处理，
+        避免配置错误让服务进入降级模式，也避免试探请求因此让熔断器一直保持打开
+        """
+        service_failure = _is_service_failure(error)
+        if self.breaker:
+            if service_failure:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+        
+        response = getattr(error, "response", None)
+        return LLMRequestError(
+            f"{self.error_prefix}调用失败: {str(error)}",
+            status=response.status_code if response is not None else None,
+            service_failure=service_failure
+        )
     
-    def chat_completion(
+    async def achat_completion(
         self,
         messages: List[Dict[str, str]],
         model: Optional[str] = None,
         temperature: float = 0.7,
-        max_tokens: int = 2000
+        max_tokens: int = 2000,
+        response_format: Optional[Dict] = None
     ) -> Dict:
-        payload = {
-            "model": model or self.default_model,
-            "messages": messages,
-            "temperature": temperature,
-            "max_tokens": max_tokens
-        }
-        
-        try:
-            response = requests.post(self.base_url, headers=self.headers, json=payload, timeout=30)
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            raise Exception(f"智谱AI API调用失败: {str(e)}")
+        """chat_completion的异步版本，在线程池中执行阻塞的HTTP请求，不阻塞事件循环"""
+        return await asyncio.to_thread(self.chat_completion, messages, model, temperature, max_tokens, response_format)
 
 
-class MoonshotClient(LLMClient):
-    """月之暗面（Moonshot）API客户端"""
+def _create_session() -> requests.Session:
+    """
+    创建带连接池的HTTP会话
     
-    def __init__(self, api_key: Optional[str] = None, model: str = "moonshot-v1-8k"):
-        self.api_key = api_key or os.getenv("MOONSHOT_API_KEY")
+    多次调用复用keep-alive连接，省去每次请求的TCP和TLS握手；
+    限流和服务端错误按指数退避自动重试，并遵守响应中的Retry-After
+    """
+    session = requests.Session()
+    retry = Retry(
+        total=4,
+        backoff_factor=0.3,
+        # 读超时不重试：大模型调用卡住时重试只会让worker再等一个完整的读超时
+        read=False,
+        status_forcelist=[408, 429, 500, 502, 503, 504],
+        allowed_methods=["POST"],
+        respect_retry_after_header=True
+    )
+    adapter = HTTPAdapter(pool_connections=32, pool_maxsize=64, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+# 所有客户端共享的HTTP会话：认证等请求头随每次请求传入，连接池按主机复用
+_SESSION = _create_session()
+
+
+def _chat_payload(
+    model: Optional[str],
+    messages: List[Dict[str, str]],
+    temperature: float,
+    max_tokens: int,
+    response_format: Optional[Dict]
+) -> Dict:
+    """构建OpenAI兼容格式的请求体，model为None时不包含该字段"""
+    payload = {
+        "messages": messages,
+        "temperature": temperature,
+        "max_tokens": max_tokens
+    }
+    if model:
+        payload["model"] = model
+    if response_format:
+        payload["response_format"] = response_format
+    return payload
+
+
+@lru_cache(maxsize=32)
+def _prompt_cache_key(system_prompt: str) -> str:
+    """根据system提示词计算prompt_cache_key（提示词是常量，哈希结果可以复用）"""
+    return hashlib.sha256(system_prompt.encode("utf-8")).hexdigest()[:32]
+
+
+@dataclass(frozen=True)
+class ProviderSpec:
+    """OpenAI兼容接口提供商的配置"""
+    # 错误信息中使用的提供商名称
+    error_label: str
+    # 环境变量前缀：{env_prefix}_API_KEY / _BASE_URL / _MODEL
+    env_prefix: str
+    base_url: str
+    default_model: str
+    # 意图识别等结构化抽取任务使用的快速模型
+    fast_model: str
+    chat_path: str = "/chat/completions"
+
+
+# 提供商注册表：名称 -> 配置
+_PROVIDERS = {
+    "deepseek": ProviderSpec("DeepSeek API", "DEEPSEEK", "https://api.deepseek.com", "deepseek-chat", "deepseek-chat",
+                             chat_path="/v1/chat/completions"),
+    "openai": ProviderSpec("OpenAI API", "OPENAI", "https://api.openai.com/v1", "gpt-3.5-turbo", "gpt-4o-mini"),
+    "qwen": ProviderSpec("通义千问API", "QWEN", "https://dashscope.aliyuncs.com/compatible-mode/v1", "qwen-turbo", "qwen-turbo"),
+    "zhipu": ProviderSpec("智谱AI API", "ZHIPU", "https://open.bigmodel.cn/api/paas/v4", "glm-4", "glm-4-flash"),
+    "moonshot": ProviderSpec("月之暗面API", "MOONSHOT", "https://api.moonshot.cn/v1", "moonshot-v1-8k", "moonshot-v1-8k"),
+}
+
+
+class OpenAICompatibleClient(LLMClient):
+    """OpenAI兼容接口的通用客户端（DeepSeek、OpenAI、通义千问、智谱AI、月之暗面）"""
+    
+    def __init__(
+        self,
+        provider: str,
+        api_key: Optional[str] = None,
+        base_url: Optional[str] = None,
+        model: Optional[str] = None
+    ):
+        """
+        初始化客户端
+        
+        Args:
+            provider: 提供商名称，见 _PROVIDERS
+            api_key: API密钥，为None时读取环境变量 {ENV_PREFIX}_API_KEY
+            base_url: 基础URL，为None时读取环境变量 {ENV_PREFIX}_BASE_URL
+            model: 默认模型，为None时读取环境变量 {ENV_PREFIX}_MODEL
+        """
+        spec = _PROVIDERS.get(provider)
+        if spec is None:
+            raise ValueError(f"不支持的LLM提供商: {provider}. 支持的提供商: {', '.join(_PROVIDERS)}")
+        
+        self.provider = provider
+        self.spec = spec
+        self.error_prefix = spec.error_label
+        
+        self.api_key = api_key or os.getenv(f"{spec.env_prefix}_API_KEY")
         if not self.api_key:
-            raise ValueError("月之暗面API密钥未设置，请设置环境变量 MOONSHOT_API_KEY")
+            raise ValueError(f"{spec.error_label}密钥未设置，请设置环境变量 {spec.env_prefix}_API_KEY")
         
-        self.base_url = "https://api.moonshot.cn/v1/chat/completions"
-        self.default_model = model or os.getenv("MOONSHOT_MODEL", "moonshot-v1-8k")
+        self.base_url = base_url or os.getenv(f"{spec.env_prefix}_BASE_URL", spec.base_url)
+        self.default_model = model or os.getenv(f"{spec.env_prefix}_MODEL", spec.default_model)
+        # 自定义地址（代理、自建兼容服务等）不一定提供该提供商的快速模型，此时使用默认模型，
+        # 需要时可通过 LLM_FAST_MODEL 显式指定
+        if self.base_url.rstrip('/') == spec.base_url.rstrip('/'):
+            self.FAST_MODEL = spec.fast_model
+        # 请求地址和是否携带prompt_cache_key在初始化时确定，不在每次请求时重新计算
+        self.chat_url = f"{self.base_url.rstrip('/')}{spec.chat_path}"
+        self.use_prompt_cache_key = "api.openai.com" in self.base_url
         self.headers = {
             "Content-Type": "application/json",
             "Authorization": f"Bearer {self.api_key}"
         }
+        self.session = _SESSION
+        self.breaker = CircuitBreaker(fail_max=10, reset_timeout=30)
+        self.cache = LLMCache(maxsize=2048, ttl=3600)
     
-    def chat_completion(
-        self,
-        messages: List[Dict[str, str]],
-        model: Optional[str] = None,
-        temperature: float = 0.7,
-        max_tokens: int = 2000
-    ) -> Dict:
-        payload = {
-            "model": model or self.default_model,
-            "messages": messages,
-            "temperature": temperature,
-            "max_tokens": max_tokens
-        }
+    def _build_request(self, messages, model, temperature, max_tokens, response_format):
+        payload = _chat_payload(model or self.default_model, messages, temperature, max_tokens, response_format)
         
-        try:
-            response = requests.post(self.base_url, headers=self.headers, json=payload, timeout=30)
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            raise Exception(f"月之暗面API调用失败: {str(e)}")
+        # OpenAI官方API支持prompt_cache_key：相同的system前缀固定路由到同一缓存节点
+        if self.use_prompt_cache_key and messages and messages[0].get("role") == "system":
+            payload["prompt_cache_key"] = _prompt_cache_key(messages[0]["content"])
+        
+        return self.chat_url, payload, None
+
+
+class AzureOpenAIClient(OpenAICompatibleClient):
+    """Azure OpenAI客户端：模型由部署名决定，请求需要携带api-version参数"""
+    
+    def __init__(self, api_key: Optional[str] = None, base_url: Optional[str] = None, model: Optional[str] = None):
+        super().__init__("openai", api_key=api_key, base_url=base_url, model=model)
+        # Azure的模型由部署名决定，不能假设存在 gpt-4o-mini 部署
+        self.FAST_MODEL = None
+        # Azure OpenAI格式: https://{resource}.openai.azure.com/openai/deployments/{deployment}/chat/completions?api-version=2024-02-15-preview
+        # 如果URL已经包含完整路径，直接使用；否则按部署名构建标准路径
+        self.full_url = "/chat/completions" in self.base_url
+        self.chat_url = self._deployment_url(self.default_model)
+        self.params = {"api-version": os.getenv("AZURE_OPENAI_API_VERSION", "2024-02-15-preview")}
+    
+    def _deployment_url(self, deployment: str) -> str:
+        if self.full_url:
+            return self.base_url
+        return f"{self.base_url.rstrip('/')}/openai/deployments/{deployment}/chat/completions"
+    
+    def _build_request(self, messages, model, temperature, max_tokens, response_format):
+        url = self._deployment_url(model) if model and model != self.default_model else self.chat_url
+        payload = _chat_payload(None, messages, temperature, max_tokens, response_format)
+        return url, payload, self.params
+
+
+class DeepSeekClient(OpenAICompatibleClient):
+    """DeepSeek API客户端（保留以向后兼容，等价于 create_llm_client("deepseek")）"""
+    
+    def __init__(self, api_key: Optional[str] = None, base_url: Optional[str] = None, model: Optional[str] = None):
+        super().__init__("deepseek", api_key=api_key, base_url=base_url, model=model)
 
 
 def create_llm_client(provider: Optional[str] = None) -> LLMClient:
@@ -247,40 +475,265 @@ def create_llm_client(provider: Optional[str] = None) -> LLMClient:
     Returns:
         LLM客户端实例
     
-    支持的表提供商：
+    支持的提供商：
     - deepseek: DeepSeek
     - openai: OpenAI / Azure OpenAI
     - qwen: 通义千问
     - zhipu: 智谱AI
     - moonshot: 月之暗面
     """
-    provider = provider or os.getenv("LLM_PROVIDER", "deepseek").lower()
+    provider = (provider or os.getenv("LLM_PROVIDER", "deepseek")).lower()
+    
+    if provider == "openai" and "azure.com" in os.getenv("OPENAI_BASE_URL", ""):
+        return AzureOpenAIClient()
+    
+    return OpenAICompatibleClient(provider)
+
+
+# 各环节的system提示词保持为模块级常量：
+# 每次请求的消息前缀逐字相同，可以命中DeepSeek/OpenAI/通义千问等服务端的前缀缓存，
+# 所有随请求变化的内容都只能放在之后的user消息中
+_INTENT_SYSTEM_PROMPT = """你是一个音乐推荐系统的意图识别助手。
+分析用户的输入，提取以下信息：
+1. 意图 (intent): "find_music", "play_song", "get_info" 等
+2. 情绪 (mood): "happy", "sad", "energetic", "calm" 等，如果没有则返回null
+3. 流派 (genre): "rock", "pop", "jazz" 等，如果没有则返回null
+4. 歌手 (artist): 歌手名称，如果没有则返回null
+5. 歌曲名 (song): 歌曲名称，如果没有则返回null
+
+请以JSON格式返回，只返回JSON，不要其他文字。"""
+
+_SEARCH_QUERY_SYSTEM_PROMPT = """你是一个音乐检索助手。
+根据用户意图，生成一个JSON格式的过滤条件，用于从音乐知识库中搜索匹配的歌曲。
+
+支持的过滤字段：
+- genre: 流派，精确匹配
+- mood: 情绪，精确匹配
+- artist: 歌手名，包含匹配
+- title: 歌曲名，包含匹配
+
+要求：
+1. 只返回JSON，不要其他解释
+2. 只能使用用户消息中给出的可用字段
+3. 如果某个条件为None，则不要包含该字段
+4. 匹配不区分大小写，流派和情绪使用英文取值（如 "rock"、"sad"）
+
+示例：
+如果意图是查找mood为"sad"的歌曲：
+    {"mood": "sad"}
+
+如果意图是查找genre为"rock"且mood为"energetic"的歌曲：
+    {"genre": "rock", "mood": "energetic"}"""
+
+_ANALYZE_SYSTEM_PROMPT = """你是一个音乐推荐助手，需要一次性完成需求分析和推荐。
+分析用户的输入，返回一个JSON对象，包含以下字段：
+1. intent: "find_music", "play_song", "get_info" 等
+2. mood: 情绪，如 "happy", "sad", "energetic", "calm"，如果没有则为null
+3. genre: 流派，如 "rock", "pop", "jazz"，如果没有则为null
+4. artist: 歌手名称，如果没有则为null
+5. song: 歌曲名称，如果没有则为null
+6. filter_spec: 用于从音乐知识库检索的过滤条件，可包含 genre（精确匹配）、mood（精确匹配）、artist（包含匹配）、title（包含匹配），流派和情绪使用英文取值，为null的条件不要包含
+7. draft_recommendation: 一段友好、简洁的中文推荐回复，提到推荐的歌曲和歌手，并解释推荐理由
+8. recommended_songs: draft_recommendation 中推荐的3-5首真实存在、广为人知的歌曲，每首包含 title、artist、genre、mood
+
+只返回JSON，不要其他文字。"""
+
+_RECOMMENDATION_SYSTEM_PROMPT = """你是一个友好的音乐推荐助手。
+根据用户的请求和匹配到的歌曲，生成一个自然、友好的推荐回复。
+回复应该：
+1. 简洁明了
+2. 提到推荐的歌曲和歌手
+3. 解释为什么推荐这些歌曲
+4. 使用中文回复
+5. 如果有多首歌曲，可以列出2-3首最相关的"""
+
+_FALLBACK_RECOMMENDATION_SYSTEM_PROMPT = """你是一个专业的音乐推荐助手。当知识库中没有匹配的歌曲时，你需要基于用户的需求推荐一些知名的、符合要求的歌曲。
+
+要求：
+1. 根据用户的情绪、流派、歌手偏好等需求，推荐3-5首知名的、符合要求的歌曲
+2. 推荐的歌曲应该是真实存在的、广为人知的经典歌曲
+3. 每首歌曲需要包含：歌曲名、歌手名、流派、情绪标签
+4. 生成一个友好的推荐回复，解释为什么推荐这些歌曲
+5. 使用中文回复
+
+请以JSON格式返回，格式如下：
+{
+    "recommendation": "推荐回复文本",
+    "recommended_songs": [
+        {
+            "title": "歌曲名",
+            "artist": "歌手名",
+            "genre": "流派",
+            "mood": "情绪"
+        },
+        ...
+    ]
+}"""
+
+# system消息同样只构建一次，各次请求共享（请求处理过程中不会修改消息内容）
+_INTENT_SYSTEM_MESSAGE = {"role": "system", "content": _INTENT_SYSTEM_PROMPT}
+_SEARCH_QUERY_SYSTEM_MESSAGE = {"role": "system", "content": _SEARCH_QUERY_SYSTEM_PROMPT}
+_ANALYZE_SYSTEM_MESSAGE = {"role": "system", "content": _ANALYZE_SYSTEM_PROMPT}
+_RECOMMENDATION_SYSTEM_MESSAGE = {"role": "system", "content": _RECOMMENDATION_SYSTEM_PROMPT}
+_FALLBACK_RECOMMENDATION_SYSTEM_MESSAGE = {"role": "system", "content": _FALLBACK_RECOMMENDATION_SYSTEM_PROMPT}
+
+
+def _extract_json(
+    text: Optional[str],
+    default: Optional[Dict] = None,
+    decoder: json.JSONDecoder = json.JSONDecoder()
+) -> Optional[Dict]:
+    """
+    从大模型回复中提取第一个JSON对象
     
-    if provider == "deepseek":
-        model = os.getenv("DEEPSEEK_MODEL", "deepseek-chat")
-        base_url = os.getenv("DEEPSEEK_BASE_URL", "https://api.deepseek.com")
-        return DeepSeekClient(model=model, base_url=base_url)
+    结构化输出模式下回复通常就是一个完整的JSON对象，先用orjson直接解析；
+    失败时再从每个 "{" 处尝试 raw_decode，自动跳过markdown代码块标记和前后的说明文字
     
-    elif provider == "openai":
-        model = os.getenv("OPENAI_MODEL", "gpt-3.5-turbo")
-        base_url = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
-        return OpenAIClient(model=model, base_url=base_url)
+    Args:
+        text: 大模型回复内容，可以为空
+        default: 找不到合法的JSON对象时的返回值
+    
+    Returns:
+        解析得到的字典，找不到时返回default
+    """
+    if not text:
+        return default
+    
+    try:
+        obj = orjson.loads(text)
+        if isinstance(obj, dict):
+            return obj
+    except orjson.JSONDecodeError:
+        pass
+    
+    i = text.find("{")
+    while i != -1:
+        try:
+            obj, _ = decoder.raw_decode(text, i)
+            return obj
+        except json.JSONDecodeError:
+            i = text.find("{", i + 1)
+    return default
+
+
+def _read_json_stream(deltas: Iterator[str]) -> str:
+    """
+    拼接流式输出的文本增量，第一个完整的JSON对象闭合后立即停止读取
+    
+    跟踪花括号深度（忽略字符串内的括号和转义字符），对象闭合后关闭流，
+    不再等待模型输出之后的说明文字
+    
+    Returns:
+        读取到的文本，找到JSON对象时在其闭合处所在的增量结束
+    """
+    parts = []
+    depth = 0
+    in_string = escaped = False
+    try:
+        for delta in deltas:
+            parts.append(delta)
+            for ch in delta:
+                if in_string:
+                    if escaped:
+                        escaped = False
+                    elif ch == "\\":
+                        escaped = True
+                    elif ch == '"':
+                        in_string = False
+                elif ch == "{":
+                    depth += 1
+                elif ch == "}" and depth:
+                    depth -= 1
+                    if not depth:
+                        return "".join(parts)
+                elif ch == '"' and depth:
+                    in_string = True
+    finally:
+        # 提前返回时关闭流，释放HTTP连接
+        close = getattr(deltas, "close", None)
+        if close:
+            close()
+    return "".join(parts)
+
+
+# 结构化搜索条件支持的字段，与 KnowledgeBase.search() 一致
+_FILTER_FIELDS = frozenset(("genre", "mood", "artist", "title"))
+# 过滤字段 -> 意图数据中的对应键（意图中的歌曲名对应title字段）
+_FILTER_INTENT_KEYS = (("genre", "genre"), ("mood", "mood"), ("artist", "artist"), ("title", "song"))
+
+
+def _normalize_filter_spec(parsed: any, intent_data: Dict[str, any]) -> Dict[str, Optional[str]]:
+    """
+    清洗大模型返回的过滤条件，只保留支持的字段
+    
+    Args:
+        parsed: 大模型返回的过滤条件（解析后的JSON）
+        intent_data: 意图识别结果，用于补齐大模型遗漏的条件
+    
+    Returns:
+        键为 genre/mood/artist/title 的过滤条件字典
+    """
+    result = {}
+    if isinstance(parsed, dict):
+        for key, value in parsed.items():
+            key = str(key).lower()
+            if key in _FILTER_FIELDS and isinstance(value, str) and value.strip():
+                result[key] = value.strip()
     
-    elif provider == "qwen":
-        model = os.getenv("QWEN_MODEL", "qwen-turbo")
-        base_url = os.getenv("QWEN_BASE_URL", "https://dashscope.aliyuncs.com/compatible-mode/v1")
-        return QwenClient(model=model, base_url=base_url)
+    # 大模型遗漏的条件用意图数据补齐
+    for field, intent_key in _FILTER_INTENT_KEYS:
+        if field not in result:
+            result[field] = intent_data.get(intent_key)
     
-    elif provider == "zhipu":
-        model = os.getenv("ZHIPU_MODEL", "glm-4")
-        return ZhipuClient(model=model)
+    return result
+
+
+def _normalize_intent(parsed: Dict[str, any]) -> Dict[str, any]:
+    """
+    清洗大模型返回的意图数据：各条件字段只保留非空字符串，其余（列表、数字等）视为None
     
-    elif provider == "moonshot":
-        model = os.getenv("MOONSHOT_MODEL", "moonshot-v1-8k")
-        return MoonshotClient(model=model)
+    Args:
+        parsed: 大模型返回的意图（解析后的JSON对象）
     
-    else:
-        raise ValueError(f"不支持的LLM提供商: {provider}. 支持的提供商: deepseek, openai, qwen, zhipu, moonshot")
+    Returns:
+        键为 intent/mood/genre/artist/song 的意图字典
+    """
+    intent_data = {"intent": parsed.get("intent") or "find_music"}
+    for key in ("mood", "genre", "artist", "song"):
+        value = parsed.get(key)
+        intent_data[key] = value.strip() if isinstance(value, str) and value.strip() else None
+    return intent_data
+
+
+# 快速意图识别使用的中文关键词 -> 知识库取值
+_MOOD_KEYWORDS = {
+    "悲伤": "sad", "伤感": "sad", "难过": "sad", "伤心": "sad", "忧伤": "sad",
+    "开心": "happy", "快乐": "happy", "高兴": "happy", "欢快": "happy", "愉快": "happy",
+    "平静": "calm", "安静": "calm", "放松": "calm", "舒缓": "calm", "轻松": "calm",
+    "激情": "energetic", "动感": "energetic", "热血": "energetic", "运动": "energetic",
+    "怀旧": "nostalgic", "史诗": "epic", "震撼": "epic", "神秘": "mysterious",
+}
+_GENRE_KEYWORDS = {
+    "摇滚": "rock", "流行": "pop", "爵士": "jazz", "古典": "classical", "民谣": "folk",
+    "拉丁": "latin", "说唱": "hip-hop", "嘻哈": "hip-hop", "电子": "electronic",
+    "乡村": "country", "蓝调": "blues", "金属": "metal",
+}
+
+# 含有否定、比较或开放式描述的输入交给大模型理解，避免关键词匹配误判（如"不要悲伤的歌"）
+_OPEN_ENDED_RE = re.compile(r"不|别|除了|以外|之外|类似|像|适合|但是|还是|或者|[?？]")
+
+# 输入过长时通常包含关键词无法表达的约束
+_FAST_INTENT_MAX_LENGTH = 30
+
+# 快速意图识别允许出现的口语填充词；去掉关键词和这些词后仍有剩余内容（歌名、年代、语种等）时交给大模型
+_FAST_INTENT_FILLERS = (
+    "我想听", "我要听", "想听", "听听", "来一首", "来几首", "来首", "来点", "放一首", "放几首", "放首", "放点",
+    "播放", "推荐", "给我", "帮我", "一些", "几首", "一首", "一点", "一下", "歌曲", "曲子", "音乐",
+    "歌", "的", "吧", "呢", "啊", "呀", "我", "听", "要", "请", "些", "首", "点",
+)
+_FAST_INTENT_FILLER_RE = re.compile(
+    "|".join(sorted(_FAST_INTENT_FILLERS, key=len, reverse=True)) + r"|[\s\W_]+", re.UNICODE
+)
 
 
 # 为了保持向后兼容，保留原来的DeepSeekClient导入
@@ -288,46 +741,72 @@ def create_llm_client(provider: Optional[str] = None) -> LLMClient:
 class MusicRecommendationClient:
     """音乐推荐客户端（使用任意LLM提供商）"""
     
-    def __init__(self, llm_client: LLMClient):
+    def __init__(self, llm_client: LLMClient, vocabulary: Optional[Dict[str, List[str]]] = None):
         """
         初始化音乐推荐客户端
         
         Args:
             llm_client: LLM客户端实例
+            vocabulary: 知识库词表（KnowledgeBase.get_vocabulary() 的返回值），用于快速意图识别
         """
         self.llm_client = llm_client
+        self._keyword_slots, self._keyword_pattern = self._build_keyword_matcher(vocabulary or {})
+        # 相同的用户输入（忽略空白和大小写）直接复用之前的大模型结果。
+        # 不按相似度匹配：长句中只改一个关键词（摇滚/流行、中文/英文）相似度仍然很高，会返回别的请求的结果
+        self.intent_cache = LLMCache(maxsize=512, ttl=600)
+        self.analysis_cache = LLMCache(maxsize=512, ttl=600)
+        self.recommendation_cache = LLMCache(maxsize=512, ttl=600)
+    
+    @property
+    def llm_available(self) -> bool:
+        """LLM服务是否可用（熔断器打开时返回False）"""
+        breaker = self.llm_client.breaker
+        return breaker is None or not breaker.is_open
+    
+    @staticmethod
+    def offline_recommendation(matched_songs: List[Dict]) -> str:
+        """
+        LLM服务不可用时使用的静态推荐回复
+        
+        Args:
+            matched_songs: 知识库中匹配的歌曲
+        
+        Returns:
+            列出匹配歌曲的推荐文本
+        """
+        if not matched_songs:
+            return "抱歉，推荐服务暂时繁忙，请稍后再试。"
+        
+        lines = ["推荐服务暂时繁忙，先为您从曲库中找到这些歌曲："]
+        lines.extend(
+            f"{i}. 《{song.get('title', '未知')}》- {song.get('artist', '未知')}"
+            for i, song in enumerate(matched_songs, 1)
+        )
+        return "\n".join(lines)
     
     def extract_intent(self, user_input: str) -> Dict[str, any]:
         """从用户输入中提取意图和实体"""
-        system_prompt = """你是一个音乐推荐系统的意图识别助手。
-分析用户的输入，提取以下信息：
-1. 意图 (intent): "find_music", "play_song", "get_info" 等
-2. 情绪 (mood): "happy", "sad", "energetic", "calm" 等，如果没有则返回null
-3. 流派 (genre): "rock", "pop", "jazz" 等，如果没有则返回null
-4. 歌手 (artist): 歌手名称，如果没有则返回null
-5. 歌曲名 (song): 歌曲名称，如果没有则返回null
-
-请以JSON格式返回，只返回JSON，不要其他文字。"""
-
+        cache_key = LLMCache.make_text_key(user_input)
+        cached = self.intent_cache.get(cache_key)
+        if cached is not None:
+            return cached
+        
         messages = [
-            {"role": "system", "content": system_prompt},
+            _INTENT_SYSTEM_MESSAGE,
             {"role": "user", "content": user_input}
         ]
         
-        response = self.llm_client.chat_completion(messages, temperature=0.3, max_tokens=500)
+        # 输出只是几十个token的JSON：用快速模型、低上限和确定性采样
+        response = self.llm_client.chat_completion(
+            messages,
+            model=self.llm_client.fast_model,
+            temperature=0,
+            max_tokens=120
+        )
         content = response["choices"][0]["message"]["content"]
         
-        # 尝试解析JSON
-        import json
-        try:
-            # 提取JSON部分（处理可能的markdown代码块）
-            if "```json" in content:
-                content = content.split("```json")[1].split("```")[0].strip()
-            elif "```" in content:
-                content = content.split("```")[1].split("```")[0].strip()
-            
-            return json.loads(content)
-        except json.JSONDecodeError:
+        intent_data = _extract_json(content)
+        if intent_data is None:
             # 如果解析失败，返回默认值
             return {
                 "intent": "find_music",
@@ -336,72 +815,181 @@ class MusicRecommendationClient:
                 "artist": None,
                 "song": None
             }
+        
+        intent_data = _normalize_intent(intent_data)
+        self.intent_cache.set(cache_key, intent_data)
+        return intent_data
     
-    def generate_search_query(self, intent_data: Dict[str, any], available_fields: List[str]) -> str:
-        """根据意图数据生成Python搜索查询"""
-        system_prompt = f"""你是一个代码生成助手。
-根据用户意图，生成一个Python列表推导式或filter表达式，用于从音乐数据列表中搜索匹配的歌曲。
-
-可用字段: {', '.join(available_fields)}
-意图数据: {intent_data}
-
-要求：
-1. 生成的代码应该是一个可执行的Python表达式
-2. 假设数据存储在名为 'songs' 的列表中，每个元素是一个字典
-3. 只返回代码，不要其他解释
-4. 如果某个条件为None，则忽略该条件
-5. 使用不区分大小写的匹配（使用.lower()）
-
-示例：
-如果意图是查找mood为"sad"的歌曲：
-    [song for song in songs if song.get('mood', '').lower() == 'sad']
-
-如果意图是查找genre为"rock"且mood为"energetic"的歌曲：
-    [song for song in songs if song.get('genre', '').lower() == 'rock' and song.get('mood', '').lower() == 'energetic']"""
-
+    @staticmethod
+    def _build_keyword_matcher(vocabulary: Dict[str, List[str]]):
+        """
+        构建快速意图识别用的关键词表和正则
+        
+        Returns:
+            (关键词 -> (字段, 取值) 的字典, 编译后的正则)；没有关键词时正则为None
+        """
+        slots = {}
+        for slot, key in (("genre", "genres"), ("mood", "moods"), ("artist", "artists")):
+            for value in vocabulary.get(key, []):
+                slots[value.lower()] = (slot, value)
+        for keyword, value in _MOOD_KEYWORDS.items():
+            slots[keyword] = ("mood", value)
+        for keyword, value in _GENRE_KEYWORDS.items():
+            slots[keyword] = ("genre", value)
+        
+        if not slots:
+            return slots, None
+        
+        # 长词优先匹配；英文词要求前后不是字母，避免 "pop" 命中 "popular"
+        alternatives = "|".join(re.escape(k) for k in sorted(slots, key=len, reverse=True))
+        pattern = re.compile(rf"(?<![a-z])(?:{alternatives})(?![a-z])", re.IGNORECASE)
+        return slots, pattern
+    
+    def extract_intent_fast(self, user_input: str) -> Optional[Dict[str, any]]:
+        """
+        用关键词匹配识别常见的简单意图（如"我想听悲伤的歌"、"来点摇滚"），无需调用大模型
+        
+        Returns:
+            意图字典；没有命中关键词、命中的条件互相冲突、输入较复杂或含有关键词以外的内容时返回None，
+            调用方应退回大模型识别
+        """
+        if not self._keyword_pattern or len(user_input) > _FAST_INTENT_MAX_LENGTH or _OPEN_ENDED_RE.search(user_input):
+            return None
+        
+        found = {}
+        for match in self._keyword_pattern.finditer(user_input):
+            slot, value = self._keyword_slots[match.group(0).lower()]
+            if found.setdefault(slot, value) != value:
+                return None
+        
+        if not found:
+            return None
+        
+        # 关键词之外还有实际内容（如"Adele的Hello"中的歌名），说明有关键词无法表达的条件
+        if _FAST_INTENT_FILLER_RE.sub("", self._keyword_pattern.sub("", user_input)):
+            return None
+        
+        return {
+            "intent": "find_music",
+            "mood": found.get("mood"),
+            "genre": found.get("genre"),
+            "artist": found.get("artist"),
+            "song": None
+        }
+    
+    def analyze_and_recommend(self, user_input: str) -> Optional[Dict[str, any]]:
+        """
+        一次大模型调用同时完成意图识别、生成搜索条件和推荐草稿
+        
+        Args:
+            user_input: 用户原始输入
+        
+        Returns:
+            包含 intent、filter_spec、draft_recommendation、recommended_songs 的字典；
+            结构化输出解析失败时返回None，调用方应退回分步调用
+        """
+        cache_key = LLMCache.make_text_key(user_input)
+        cached = self.analysis_cache.get(cache_key)
+        if cached is not None:
+            return cached
+        
         messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": f"请为以下意图生成搜索查询：{intent_data}"}
+            _ANALYZE_SYSTEM_MESSAGE,
+            {"role": "user", "content": user_input}
         ]
         
-        response = self.llm_client.chat_completion(messages, temperature=0.2, max_tokens=300)
-        query = response["choices"][0]["message"]["content"].strip()
+        response = self.llm_client.chat_completion(
+            messages,
+            temperature=0.5,
+            max_tokens=1000,
+            response_format={"type": "json_object"}
+        )
+        content = response["choices"][0]["message"]["content"]
+        
+        parsed = _extract_json(content)
+        if parsed is None or not isinstance(parsed.get("draft_recommendation"), str):
+            return None
         
-        # 清理可能的代码块标记
-        if "```python" in query:
-            query = query.split("```python")[1].split("```")[0].strip()
-        elif "```" in query:
-            query = query.split("```")[1].split("```")[0].strip()
+        intent_data = _normalize_intent(parsed)
+        songs = parsed.get("recommended_songs")
+        result = {
+            "intent": intent_data,
+            "filter_spec": _normalize_filter_spec(parsed.get("filter_spec"), intent_data),
+            "draft_recommendation": parsed["draft_recommendation"],
+            "recommended_songs": [song for song in songs if isinstance(song, dict)] if isinstance(songs, list) else []
+        }
         
-        return query
+        self.analysis_cache.set(cache_key, result)
+        return result
     
-    def generate_recommendation(self, user_input: str, matched_songs: List[Dict], intent_data: Dict) -> str:
-        """根据匹配的歌曲生成推荐回复"""
-        system_prompt = """你是一个友好的音乐推荐助手。
-根据用户的请求和匹配到的歌曲，生成一个自然、友好的推荐回复。
-回复应该：
-1. 简洁明了
-2. 提到推荐的歌曲和歌手
-3. 解释为什么推荐这些歌曲
-4. 使用中文回复
-5. 如果有多首歌曲，可以列出2-3首最相关的"""
-
-        songs_info = "\n".join([
-            f"- {song.get('title', '未知')} by {song.get('artist', '未知')} ({song.get('genre', '未知')}, {song.get('mood', '未知')})"
-            for song in matched_songs[:5]
-        ])
+    @staticmethod
+    def draft_covers_songs(draft: str, matched_songs: List[Dict]) -> bool:
+        """
+        判断推荐草稿是否已经提到了知识库匹配到的歌曲
         
+        草稿提到了至少两首（匹配结果不足两首时为全部）匹配歌曲时，
+        无需再调用大模型根据匹配结果重写推荐回复
+        """
+        mentioned = sum(1 for song in matched_songs[:5] if song.get('title') and song['title'] in draft)
+        return mentioned >= min(2, len(matched_songs))
+    
+    def generate_search_query(self, intent_data: Dict[str, any], available_fields: List[str]) -> Dict[str, Optional[str]]:
+        """
+        根据意图数据生成结构化的搜索条件
+        
+        Returns:
+            过滤条件字典，键为 genre/mood/artist/title，可直接传给 KnowledgeBase.search()
+        """
+        available_allowed = ", ".join(f for f in available_fields if f in _FILTER_FIELDS)
+        
+        # 动态内容全部放在user消息中，保证system前缀逐字不变，便于服务端缓存
         messages = [
-            {"role": "system", "content": system_prompt},
+            _SEARCH_QUERY_SYSTEM_MESSAGE,
             {
                 "role": "user",
-                "content": f"用户说：{user_input}\n\n匹配到的歌曲：\n{songs_info}\n\n请生成推荐回复："
+                "content": f"可用字段: {available_allowed}\n意图数据: {intent_data}\n\n请为以上意图生成过滤条件："
             }
         ]
         
+        response = self.llm_client.chat_completion(
+            messages,
+            model=self.llm_client.fast_model,
+            temperature=0,
+            max_tokens=80
+        )
+        content = response["choices"][0]["message"]["content"]
+        
+        # 提取JSON对象（处理可能的markdown代码块或多余文字）
+        parsed = _extract_json(content, default={})
+        
+        return _normalize_filter_spec(parsed, intent_data)
+    
+    def _recommendation_messages(self, user_input: str, matched_songs: List[Dict]) -> List[Dict[str, str]]:
+        """构建根据匹配歌曲生成推荐回复的消息列表"""
+        songs_info = "\n".join(
+            f"- {song.get('title', '未知')} by {song.get('artist', '未知')} ({song.get('genre', '未知')}, {song.get('mood', '未知')})"
+            for song in islice(matched_songs, 5)
+        )
+        
+        return [
+            _RECOMMENDATION_SYSTEM_MESSAGE,
+            {
+                "role": "user",
+                "content": f"用户说：{user_input}\n\n匹配到的歌曲：\n{songs_info}\n\n请生成推荐回复："
+            }
+        ]
+    
+    def generate_recommendation(self, user_input: str, matched_songs: List[Dict], intent_data: Dict) -> str:
+        """根据匹配的歌曲生成推荐回复"""
+        messages = self._recommendation_messages(user_input, matched_songs)
         response = self.llm_client.chat_completion(messages, temperature=0.8, max_tokens=500)
         return response["choices"][0]["message"]["content"]
     
+    def stream_recommendation(self, user_input: str, matched_songs: List[Dict], intent_data: Dict) -> Iterator[str]:
+        """generate_recommendation 的流式版本，逐段返回推荐回复文本"""
+        messages = self._recommendation_messages(user_input, matched_songs)
+        return self.llm_client.stream_chat_completion(messages, temperature=0.8, max_tokens=500)
+    
     def generate_recommendation_without_matches(self, user_input: str, intent_data: Dict) -> Dict[str, any]:
         """
         当知识库中没有匹配歌曲时，让大模型推荐通用歌曲
@@ -413,29 +1001,12 @@ class MusicRecommendationClient:
         Returns:
             包含推荐回复和推荐歌曲列表的字典
         """
-        system_prompt = """你是一个专业的音乐推荐助手。当知识库中没有匹配的歌曲时，你需要基于用户的需求推荐一些知名的、符合要求的歌曲。
-
-要求：
-1. 根据用户的情绪、流派、歌手偏好等需求，推荐3-5首知名的、符合要求的歌曲
-2. 推荐的歌曲应该是真实存在的、广为人知的经典歌曲
-3. 每首歌曲需要包含：歌曲名、歌手名、流派、情绪标签
-4. 生成一个友好的推荐回复，解释为什么推荐这些歌曲
-5. 使用中文回复
-
-请以JSON格式返回，格式如下：
-{
-    "recommendation": "推荐回复文本",
-    "recommended_songs": [
-        {
-            "title": "歌曲名",
-            "artist": "歌手名",
-            "genre": "流派",
-            "mood": "情绪"
-        },
-        ...
-    ]
-}"""
-
+        # 相同的意图才能复用推荐结果
+        cache_key = LLMCache.make_text_key(user_input, intent_data)
+        cached = self.recommendation_cache.get(cache_key)
+        if cached is not None:
+            return cached
+        
         # 构建用户需求描述
         requirements = []
         if intent_data.get('mood'):
@@ -450,38 +1021,53 @@ class MusicRecommendationClient:
         requirements_text = "、".join(requirements) if requirements else "通用推荐"
         
         messages = [
-            {"role": "system", "content": system_prompt},
+            _FALLBACK_RECOMMENDATION_SYSTEM_MESSAGE,
             {
                 "role": "user",
                 "content": f"用户说：{user_input}\n\n用户需求：{requirements_text}\n\n请基于这些需求推荐合适的歌曲："
             }
         ]
         
-        response = self.llm_client.chat_completion(messages, temperature=0.8, max_tokens=1000)
-        content = response["choices"][0]["message"]["content"]
+        # 流式读取，JSON对象一闭合就停止，不等待模型输出结尾的说明文字
+        content = _read_json_stream(
+            self.llm_client.stream_chat_completion(messages, temperature=0.8, max_tokens=1000)
+        )
         
-        # 尝试解析JSON
-        import json
-        try:
-            # 提取JSON部分（处理可能的markdown代码块）
-            if "```json" in content:
-                content = content.split("```json")[1].split("```")[0].strip()
-            elif "```" in content:
-                content = content.split("```")[1].split("```")[0].strip()
-            
-            result = json.loads(content)
-            
-            # 验证返回格式
-            if "recommendation" not in result:
-                result["recommendation"] = content
-            if "recommended_songs" not in result:
-                result["recommended_songs"] = []
-            
-            return result
-        except json.JSONDecodeError:
+        result = _extract_json(content)
+        if result is None:
             # 如果解析失败，返回一个友好的回复
             return {
                 "recommendation": content if content else "抱歉，我暂时无法为您推荐具体的歌曲。建议您尝试搜索特定的歌手、流派或情绪关键词。",
                 "recommended_songs": []
             }
-
+        
+        # 验证返回格式
+        if "recommendation" not in result:
+            result["recommendation"] = content
+        if "recommended_songs" not in result:
+            result["recommended_songs"] = []
+        
+        self.recommendation_cache.set(cache_key, result)
+        return result
+    
+    # ---- 异步版本：在线程池中执行，供异步视图并发调度多个大模型请求 ----
+    
+    async def aextract_intent(self, user_input: str) -> Dict[str, any]:
+        """extract_intent 的异步版本"""
+        return await asyncio.to_thread(self.extract_intent, user_input)
+    
+    async def aanalyze_and_recommend(self, user_input: str) -> Optional[Dict[str, any]]:
+        """analyze_and_recommend 的异步版本"""
+        return await asyncio.to_thread(self.analyze_and_recommend, user_input)
+    
+    async def agenerate_search_query(self, intent_data: Dict[str, any], available_fields: List[str]) -> Dict[str, Optional[str]]:
+        """generate_search_query 的异步版本"""
+        return await asyncio.to_thread(self.generate_search_query, intent_data, available_fields)
+    
+    async def agenerate_recommendation(self, user_input: str, matched_songs: List[Dict], intent_data: Dict) -> str:
+        """generate_recommendation 的异步版本"""
+        return await asyncio.to_thread(self.generate_recommendation, user_input, matched_songs, intent_data)
+    
+    async def agenerate_recommendation_without_matches(self, user_input: str, intent_data: Dict) -> Dict[str, any]:
+        """generate_recommendation_without_matches 的异步版本"""
+        return await asyncio.to_thread(self.generate_recommendation_without_matches, user_input, intent_data)
@@ -22,16 +22,16 @@ fi
 
 # 检查依赖是否安装
 echo "[信息] 检查依赖..."
-if ! python3 -c "import flask" &> /dev/null; then
+if ! python3 -c "import flask, gunicorn" &> /dev/null; then
     echo "[信息] 安装依赖..."
     pip3 install -r requirements.txt
 fi
 
 echo ""
-echo "[信息] 启动Flask应用..."
+echo "[信息] 启动服务（gunicorn 多进程）..."
 echo "[信息] 服务将在 http://127.0.0.1:5000 启动"
 echo "[信息] 按 Ctrl+C 停止服务"
 echo ""
 
-python3 app.py
+python3 -m gunicorn -c gunicorn.conf.py app:app
 